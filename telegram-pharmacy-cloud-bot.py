@@ -1,19 +1,33 @@
 # -*- coding: utf-8 -*-
 import os
+import json
+import re
+import time
+import hashlib
+import unicodedata
+import asyncio
+import contextlib
+import signal
 import threading
 import logging
-from flask import Flask, request, jsonify
+from concurrent.futures import ProcessPoolExecutor
+from quart import Quart, request, jsonify
+from quart_cors import cors
+import uvicorn
+from collections import OrderedDict
+from functools import partial
 from pathlib import Path
-from datetime import datetime
-import PyPDF2
+from datetime import datetime, date
+import pymupdf
 import pandas as pd
 from telegram import Update
 from telegram.constants import ChatAction, ParseMode
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler,
     ContextTypes, filters,
 )
-from anthropic import AsyncAnthropic, DefaultAioHttpClient
+from anthropic import APIError, AsyncAnthropic, DefaultAioHttpClient
 
 # ========= CONFIG =========
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
@@ -21,6 +35,13 @@ ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
 PDF_FOLDER = os.getenv("PDF_FOLDER", "catalogos_pdfs")
 CATALOG_FILE = os.getenv("CATALOG_FILE", "catalogo_procesado.txt")
 PROMO_FILE = os.getenv("PROMO_FILE", "FORMATO PROMOCIONAL.xlsx")
+PRODUCTS_FILE = os.getenv("PRODUCTS_FILE", "productos.json")
+CATALOG_INDEX_FILE = os.getenv("CATALOG_INDEX_FILE", "catalog_index.json")
+CATALOG_SHARDS_DIR = os.getenv("CATALOG_SHARDS_DIR", "catalog_shards")
+PROMO_CACHE_DIR = os.getenv("PROMO_CACHE_DIR", "promos_parquet")
+TOP_K = int(os.getenv("TOP_K", 50))
+# Con un catálogo mayor a esto se envían solo los productos relevantes en vez del catálogo completo
+MAX_CATALOG_CHARS = int(os.getenv("MAX_CATALOG_CHARS", 150000))
 
 # ========= LOGGING ========
 logging.basicConfig(
@@ -28,42 +49,207 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ========= CACHE ==========
+# clave -> (versión, texto); la versión es el mtime del archivo de origen
+_CATALOG_CACHE: dict[str, tuple[object, str]] = {}
+
+def _mtime(path: str) -> float | None:
+    try:
+        return os.stat(path).st_mtime
+    except FileNotFoundError:
+        return None
+
 # ========= PDFs ===========
 def extract_text_from_pdf(pdf_path: Path) -> str:
     try:
-        text = ""
-        with open(pdf_path, "rb") as f:
-            reader = PyPDF2.PdfReader(f)
-            for page in reader.pages:
-                txt = page.extract_text() or ""
-                text += txt + "\n"
-        return text
+        with pymupdf.open(pdf_path) as doc:
+            # sort=True: orden de lectura, cada fila de la tabla queda en una línea
+            return "\n".join(page.get_text("text", sort=True) for page in doc)
     except Exception as e:
         logger.error(f"Error al leer {pdf_path}: {e}")
         return ""
 
+# Los loaders corren en hilos (asyncio.to_thread); un /actualizar a la vez escribe archivos
+_LOAD_LOCK = threading.Lock()
+
 def load_all_pdfs() -> str:
+    with _LOAD_LOCK:
+        return _load_all_pdfs()
+
+def _load_all_pdfs() -> str:
     Path(PDF_FOLDER).mkdir(exist_ok=True)
     pdf_files = list(Path(PDF_FOLDER).glob("*.pdf"))
     if not pdf_files:
         logger.warning(f"No se encontraron PDFs en '{PDF_FOLDER}'")
         return ""
-    full_catalog = ""
-    for pdf_file in sorted(pdf_files):
-        logger.info(f"Leyendo: {pdf_file.name}")
-        text = extract_text_from_pdf(pdf_file)
+    pdf_files = sorted(pdf_files)
+    # Índice nombre -> {size, mtime}: solo se vuelven a extraer los PDFs que cambiaron
+    try:
+        with open(CATALOG_INDEX_FILE, "r", encoding="utf-8") as f:
+            old_index = json.load(f)
+    except (FileNotFoundError, ValueError):
+        old_index = {}
+    shards = Path(CATALOG_SHARDS_DIR)
+    shards.mkdir(exist_ok=True)
+    index, texts, changed = {}, {}, []
+    for pdf_file in pdf_files:
+        st = pdf_file.stat()
+        entry = old_index.get(pdf_file.name)
+        shard = shards / f"{pdf_file.name}.txt"
+        if entry and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime and shard.exists():
+            texts[pdf_file.name] = shard.read_text(encoding="utf-8")
+            index[pdf_file.name] = entry
+        else:
+            changed.append(pdf_file)
+    if changed:
+        logger.info(f"Leyendo {len(changed)} PDFs: {', '.join(p.name for p in changed)}")
+        # Extracción en paralelo: un proceso por PDF (CPU-bound)
+        with ProcessPoolExecutor(max_workers=min(len(changed), os.cpu_count() or 1)) as ex:
+            for pdf_file, text in zip(changed, ex.map(extract_text_from_pdf, changed)):
+                texts[pdf_file.name] = text
+                if not text:
+                    continue  # lectura fallida o vacía: sin shard ni entrada, se reintenta en el próximo /actualizar
+                st = pdf_file.stat()
+                (shards / f"{pdf_file.name}.txt").write_text(text, encoding="utf-8")
+                index[pdf_file.name] = {"size": st.st_size, "mtime": st.st_mtime}
+    with open(CATALOG_INDEX_FILE, "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False, indent=1)
+    for shard in shards.glob("*.txt"):
+        if shard.name.removesuffix(".txt") not in index:
+            shard.unlink(missing_ok=True)  # PDF borrado (o sin texto): su shard ya no se usa
+    parts = []
+    for pdf_file in pdf_files:
+        text = texts[pdf_file.name]
         if text:
-            full_catalog += f"\n{'='*60}\nARCHIVO: {pdf_file.name}\n{'='*60}\n{text}"
+            parts.append(f"\n{'='*60}\nARCHIVO: {pdf_file.name}\n{'='*60}\n{text}")
+    full_catalog = "".join(parts)
+    # Sin cambios no se reescribe: el mtime (versión de las cachés) y el prefijo del prompt se mantienen
+    if _mtime(CATALOG_FILE) is not None and get_catalog() == full_catalog:
+        logger.info(f"Catálogo sin cambios ({len(full_catalog)} chars)")
+        return full_catalog
     with open(CATALOG_FILE, "w", encoding="utf-8") as f:
         f.write(full_catalog)
+    _CATALOG_CACHE["catalog"] = (_mtime(CATALOG_FILE), full_catalog)
     logger.info(f"Catálogo guardado en '{CATALOG_FILE}' ({len(full_catalog)} chars)")
+    save_products(parse_products(full_catalog))
     return full_catalog
 
 def get_catalog() -> str:
-    if os.path.exists(CATALOG_FILE):
-        with open(CATALOG_FILE, "r", encoding="utf-8") as f:
-            return f.read()
-    return load_all_pdfs()
+    mtime = _mtime(CATALOG_FILE)
+    if mtime is None:
+        return load_all_pdfs()
+    cached = _CATALOG_CACHE.get("catalog")
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(CATALOG_FILE, "r", encoding="utf-8") as f:
+        catalog = f.read()
+    _CATALOG_CACHE["catalog"] = (mtime, catalog)
+    return catalog
+
+# ========= Índice de productos =========
+# versión del catálogo -> (productos, texto normalizado de cada producto, código -> producto)
+_PRODUCTS_CACHE: dict[str, tuple[object, list[dict], list[str], dict[str, dict]]] = {}
+
+_SOURCE_RE = re.compile(r"^ARCHIVO:\s*(.+?)\s*$")
+_HEADER_RE = re.compile(r"^([^|\d][^|]*?)\s*\|\s*(.+?)\s*$")  # "MEDICINA | LABORATORIO"
+_STAMP_RE = re.compile(r"Dpto\. Marketing\s+\d{4}|\b[A-Z][a-z]{2}-\d{4}")  # sellos de página en la línea de cabecera
+PRODUCTS_FORMAT = 2  # cambia si cambia parse_products: invalida productos.json
+_PRODUCT_RE = re.compile(r"^(\d{4,8})\s+(.+?)\s+S/\s*(\d+(?:[.,]\d+)?)\s*(.*?)\s*$")  # "Cod Descrip S/ Pvp Principio"
+
+def normalize_text(text: str) -> str:
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(re.sub(r"[^\w\s]", " ", text).split())
+
+def parse_products(catalog_text: str) -> list[dict]:
+    products = []
+    fuente = categoria = laboratorio = ""
+    for line in catalog_text.splitlines():
+        line = line.strip()
+        if m := _SOURCE_RE.match(line):
+            fuente = m.group(1)
+        elif m := _PRODUCT_RE.match(line):
+            codigo, nombre, precio, principio_activo = (" ".join(g.split()) for g in m.groups())
+            products.append({
+                "codigo": codigo, "nombre": nombre, "precio": precio.replace(",", "."),
+                "principio_activo": principio_activo, "laboratorio": laboratorio,
+                "categoria": categoria, "notas": "", "fuente": fuente,
+            })
+        elif m := _HEADER_RE.match(_STAMP_RE.sub(" ", line).strip()):
+            categoria, laboratorio = (" ".join(g.split()) for g in m.groups())
+    return products
+
+def save_products(products: list[dict]) -> None:
+    with open(PRODUCTS_FILE, "w", encoding="utf-8") as f:
+        json.dump({"formato": PRODUCTS_FORMAT, "productos": products}, f, ensure_ascii=False)
+    logger.info(f"Índice guardado en '{PRODUCTS_FILE}' ({len(products)} productos)")
+
+def get_products() -> tuple[list[dict], list[str]]:
+    catalog = get_catalog()
+    version = _CATALOG_CACHE.get("catalog", (None,))[0]
+    cached = _PRODUCTS_CACHE.get("products")
+    if cached and cached[0] == version:
+        return cached[1], cached[2]
+    products = None
+    index_mtime = _mtime(PRODUCTS_FILE)
+    if index_mtime is not None and version is not None and index_mtime >= version:
+        with open(PRODUCTS_FILE, "r", encoding="utf-8") as f:
+            stored = json.load(f)
+        if isinstance(stored, dict) and stored.get("formato") == PRODUCTS_FORMAT:
+            products = stored["productos"]
+    if products is None:
+        products = parse_products(catalog)
+        save_products(products)
+    haystacks = [normalize_text(" ".join(p.values())) for p in products]
+    code_to_record = {p["codigo"]: p for p in products}
+    _PRODUCTS_CACHE["products"] = (version, products, haystacks, code_to_record)
+    return products, haystacks
+
+def get_product_by_code(code: str) -> dict | None:
+    get_products()
+    return _PRODUCTS_CACHE["products"][3].get(code)
+
+def format_product(p: dict) -> str:
+    return (f"💊 {p['codigo']} | {p['nombre']} | S/ {p['precio']} | {p['principio_activo'] or '-'} | "
+            f"{p['laboratorio'] or '-'} | {p['categoria'] or '-'} | {p['fuente']}")
+
+def search_products(question: str, k: int = TOP_K) -> list[dict]:
+    terms = {t for t in normalize_text(question).split() if len(t) >= 3}
+    if not terms:
+        return []
+    products, haystacks = get_products()
+    scored = [(sum(t in h for t in terms), i) for i, h in enumerate(haystacks)]
+    scored = sorted((x for x in scored if x[0] > 0), key=lambda x: (-x[0], x[1]))
+    return [products[i] for _, i in scored[:k]]
+
+CODE_RE = re.compile(r"\b\d{4,8}\b")
+# Palabras que pueden acompañar a los códigos en una consulta literal; cualquier otra
+# (promoción, bonificación, stock, ...) cambia la intención y la consulta va a la IA
+LOOKUP_WORDS = {"precio", "precios", "pvp", "codigo", "codigos", "cod", "sku", "producto", "productos",
+                "cual", "cuanto", "cuesta", "es", "el", "la", "los", "las", "del", "de", "y", "info", "dame"}
+PROMOS_QUERIES = {"promociones", "promociones vigentes", "promos", "promos vigentes"}
+QUICK_PROMOS_MAX_CHARS = 7800  # ~2 mensajes de Telegram; si hay más vigentes, responde la IA
+
+def quick_answer(question: str) -> str | None:
+    """Respuesta directa sin IA para consultas literales: códigos de producto o listado de promociones."""
+    codes = CODE_RE.findall(question)
+    if codes and set(CODE_RE.sub(" ", normalize_text(question)).split()) <= LOOKUP_WORDS:
+        hits = [get_product_by_code(c) for c in codes]
+        if all(hits):
+            return "\n\n".join(
+                f"💊 {p['nombre']}\n🔢 Código: {p['codigo']}\n💰 Precio: S/ {p['precio']}\n"
+                f"🧪 Principio activo: {p['principio_activo'] or '-'}\n🏭 Laboratorio: {p['laboratorio'] or '-'}\n"
+                f"📂 Categoría: {p['categoria'] or '-'}\n📄 Documento: {p['fuente']}"
+                for p in hits
+            )
+    if normalize_text(question) in PROMOS_QUERIES:
+        today = date.today()
+        promos = current_promotions(today)
+        if not promos:
+            return f"⚠️ No hay promociones vigentes hoy ({today:%d/%m/%Y})."
+        if len(promos) <= QUICK_PROMOS_MAX_CHARS:
+            return f"🎁 Promociones vigentes ({today:%d/%m/%Y}):\n{promos}"
+    return None
 
 # ========= Excel ==========
 def load_promotions_and_bonuses() -> str:
@@ -71,24 +257,100 @@ def load_promotions_and_bonuses() -> str:
         logger.warning(f"No se encontró el archivo de promociones ... '{PROMO_FILE}'")
         return ""
     try:
-        # Usa el motor openpyxl explícitamente
-        xls = pd.ExcelFile(PROMO_FILE, engine="openpyxl")
         text_blocks = []
-        for sheet_name in xls.sheet_names:
-            df = pd.read_excel(PROMO_FILE, sheet_name=sheet_name, engine="openpyxl")
-            df.fillna("-", inplace=True)
+        for sheet_name, df in load_promo_sheets():
             text_blocks.append(f"\n{'='*60}\nHOJA: {sheet_name}\n{'='*60}\n")
-            text_blocks.append(df.to_string(index=False))
+            # CSV con "|" (en C) en vez de to_string: sin relleno de espacios, menos tokens
+            text_blocks.append(df.to_csv(sep="|", index=False))
         return "\n".join(text_blocks)
     except Exception as e:
         logger.error(f"Error leyendo Excel: {e}")
         return f"(Error leyendo Excel: {e})"
 
-def get_full_knowledge() -> str:
+PROMO_CACHE_FORMAT = 2  # cambia si cambia cómo se leen las hojas: invalida la caché Parquet
+
+def load_promo_sheets() -> list[tuple[str, pd.DataFrame]]:
+    """Hojas del Excel desde la caché Parquet; se regenera solo si cambia el mtime del .xlsx."""
+    manifest_path = Path(PROMO_CACHE_DIR) / "hojas.json"
+    mtime = _mtime(PROMO_FILE)
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest["mtime"] == mtime and manifest.get("formato") == PROMO_CACHE_FORMAT:
+            return [(name, pd.read_parquet(Path(PROMO_CACHE_DIR) / f"{i:02d}.parquet"))
+                    for i, name in enumerate(manifest["hojas"])]
+    except (FileNotFoundError, KeyError, ValueError, OSError):
+        pass
+    # Usa el motor openpyxl explícitamente
+    sheets = []
+    for sheet_name, raw in pd.read_excel(PROMO_FILE, sheet_name=None, header=None, engine="openpyxl").items():
+        # La cabecera no siempre está en la primera fila (p. ej. "Promociones" la tiene en la 2)
+        header_row = next((i for i, row in raw.head(10).iterrows()
+                           if {"DE", "HASTA"} <= {str(v).strip() for v in row}), 0)
+        df = raw.iloc[header_row + 1 :].reset_index(drop=True)
+        df.columns = [str(c).strip() if pd.notna(c) else f"col{i}" for i, c in enumerate(raw.iloc[header_row])]
+        # Todo como texto: el destino es el prompt y Parquet exige tipos homogéneos por columna
+        df = df.fillna("-").astype(str)
+        sheets.append((str(sheet_name), df))
+    try:
+        Path(PROMO_CACHE_DIR).mkdir(exist_ok=True)
+        for i, (_, df) in enumerate(sheets):
+            df.to_parquet(Path(PROMO_CACHE_DIR) / f"{i:02d}.parquet", engine="pyarrow", compression="zstd", index=False)
+        with open(manifest_path, "w", encoding="utf-8") as f:
+            json.dump({"mtime": mtime, "formato": PROMO_CACHE_FORMAT, "hojas": [name for name, _ in sheets]}, f, ensure_ascii=False)
+    except Exception as e:
+        logger.warning(f"No se pudo escribir la caché Parquet: {e}")
+    return sheets
+
+def current_promotions(today: date) -> str:
+    """Filas de cada hoja con DE <= hoy <= HASTA, como CSV con "|"."""
+    day = pd.Timestamp(today)
+    blocks = []
+    for sheet_name, df in load_promo_sheets():
+        if "DE" not in df.columns or "HASTA" not in df.columns:
+            continue
+        start = pd.to_datetime(df["DE"], errors="coerce", format="mixed")
+        end = pd.to_datetime(df["HASTA"], errors="coerce", format="mixed")
+        rows = df[(start <= day) & (end >= day)]
+        if not rows.empty:
+            blocks.append(f"HOJA: {sheet_name}\n{rows.to_csv(sep='|', index=False)}")
+    return "\n".join(blocks)
+
+def get_promotions() -> tuple[float | None, str]:
+    """(versión, texto): la versión se devuelve aquí porque /promos puede vaciar la caché desde otro hilo."""
+    mtime = _mtime(PROMO_FILE)
+    cached = _CATALOG_CACHE.get("promos")
+    if cached and mtime is not None and cached[0] == mtime:
+        return cached
+    promos = load_promotions_and_bonuses()
+    _CATALOG_CACHE["promos"] = (mtime, promos)
+    return mtime, promos
+
+def get_full_knowledge() -> tuple[object, str]:
     catalog_text = get_catalog()
-    promo_text = load_promotions_and_bonuses()
+    promo_version, promo_text = get_promotions()
+    version = (_CATALOG_CACHE.get("catalog", (None,))[0], promo_version)
+    cached = _CATALOG_CACHE.get("knowledge")
+    if cached and cached[0] == version:
+        return cached
     combined = f"CATÁLOGO DE PRODUCTOS:\n{catalog_text}\n\nPROMOCIONES Y BONIFICACIONES:\n{promo_text}"
-    return combined
+    _CATALOG_CACHE["knowledge"] = (version, combined)
+    return version, combined
+
+def get_knowledge_for(question: str) -> tuple[object, str, str]:
+    """(versión, base estable, parte según la pregunta).
+
+    Con un catálogo de hasta MAX_CATALOG_CHARS la base estable es todo y no hay parte variable;
+    si es mayor, la base estable son las promociones y la parte variable los TOP_K productos relevantes.
+    """
+    version, knowledge = get_full_knowledge()
+    if len(get_catalog()) <= MAX_CATALOG_CHARS:
+        return version, knowledge, ""
+    hits = search_products(question)
+    if not hits:
+        return version, knowledge, ""
+    products = "\n".join(format_product(p) for p in hits)
+    return version, f"PROMOCIONES Y BONIFICACIONES:\n{get_promotions()[1]}", f"PRODUCTOS RELEVANTES:\n{products}"
 
 # ========= PROMPT =========
 SYSTEM_PROMPT = """
@@ -105,9 +367,71 @@ INSTRUCCIONES:
 6) Si no encuentras exacto, sugiere similares.
 """
 
+# Bloques con cache_control: el prefijo (sistema + base de conocimiento) es idéntico
+# entre llamadas, así Anthropic reutiliza el prompt cacheado y solo procesa lo que varía.
+SYSTEM_BLOCKS = [{"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}]
+
+def build_messages(knowledge: str, question: str, extra: str = "") -> list[dict]:
+    content = [{"type": "text", "text": f"BASE DE CONOCIMIENTO:\n{knowledge}\n---", "cache_control": {"type": "ephemeral"}}]
+    if extra:
+        content.append({"type": "text", "text": f"{extra}\n---"})  # cambia con cada pregunta: sin cache_control
+    content.append({"type": "text", "text": f"Pregunta: {question}\nResponde en español."})
+    return [{"role": "user", "content": content}]
+
+# ========= Caché de respuestas =========
+class LLMCache:
+    """Respuestas previas por pregunta normalizada + versión de la base de conocimiento (TTL + LRU)."""
+
+    def __init__(self, ttl: float = 3600.0, max_items: int = 1000):
+        self.ttl = ttl
+        self.max_items = max_items
+        self._data: OrderedDict[str, tuple[float, str]] = OrderedDict()
+
+    @staticmethod
+    def normalize(question: str) -> str:
+        return normalize_text(question)
+
+    def key(self, version, question: str) -> str:
+        return hashlib.sha256(f"{version}|{self.normalize(question)}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        hit = self._data.get(key)
+        if hit is None:
+            return None
+        if time.time() - hit[0] > self.ttl:
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return hit[1]
+
+    def set(self, key: str, answer: str) -> None:
+        self._data[key] = (time.time(), answer)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_items:
+            self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+RESPONSE_CACHE = LLMCache()
+
 PREFERRED_ALIAS = "claude-sonnet-4-5"
+MODEL_TTL = 3600.0
+MODEL_PRIORITY = ("sonnet", "haiku")  # familias aceptadas si falla PREFERRED_ALIAS, en orden de preferencia
+STREAM_EDIT_INTERVAL = 1.0
+_MODEL_CACHE: dict = {"id": None, "ts": 0.0}
 
 async def pick_available_model(client: AsyncAnthropic) -> str:
+    if _MODEL_CACHE["id"] and time.time() - _MODEL_CACHE["ts"] < MODEL_TTL:
+        return _MODEL_CACHE["id"]
+    model_id = await _probe_model(client)
+    _MODEL_CACHE.update(id=model_id, ts=time.time())
+    return model_id
+
+def _model_rank(model_id: str) -> int:
+    return next((r for r, k in enumerate(MODEL_PRIORITY) if k in model_id), len(MODEL_PRIORITY))
+
+async def _probe_model(client: AsyncAnthropic) -> str:
     try:
         _ = await client.messages.create(
             model=PREFERRED_ALIAS, max_tokens=8, system="Test",
@@ -117,19 +441,66 @@ async def pick_available_model(client: AsyncAnthropic) -> str:
     except Exception:
         page = await client.models.list()
         ids = [getattr(m, "id", None) or (isinstance(m, dict) and m.get("id")) for m in getattr(page, "data", [])]
-        for mid in ids:
-            if "sonnet" in mid: return mid
-        for mid in ids:
-            if "haiku" in mid: return mid
-        raise RuntimeError("No hay modelos válidos para esta API key.")
+        # Una sola pasada: min() conserva el orden de la API entre modelos de la misma familia
+        best = min(filter(None, ids), key=_model_rank, default=None)
+        if best is None or _model_rank(best) == len(MODEL_PRIORITY):
+            raise RuntimeError("No hay modelos válidos para esta API key.")
+        return best
+
+# Cliente único para el bot y la API: conserva el pool de conexiones entre mensajes.
+# Se crea perezosamente para quedar ligado al event loop de la aplicación.
+_ANTHROPIC_CLIENT: AsyncAnthropic | None = None
+
+def get_anthropic() -> AsyncAnthropic:
+    global _ANTHROPIC_CLIENT
+    if _ANTHROPIC_CLIENT is None:
+        _ANTHROPIC_CLIENT = AsyncAnthropic(api_key=ANTHROPIC_API_KEY, http_client=DefaultAioHttpClient(), timeout=60.0, max_retries=2)
+    return _ANTHROPIC_CLIENT
+
+async def close_anthropic() -> None:
+    global _ANTHROPIC_CLIENT
+    if _ANTHROPIC_CLIENT is not None:
+        await _ANTHROPIC_CLIENT.close()
+        _ANTHROPIC_CLIENT = None
 
 # ========= Telegram Handlers =========
+MAX_LEN = 3900  # límite de Telegram: 4096 chars por mensaje
+MAX_PARALLEL_CHUNKS = 3  # Telegram admite ~1 mensaje/seg por chat; más trozos se envían en orden
+
+async def tg_call(make, wait: bool = True):
+    """Llama a Telegram; tras RetryAfter espera y reintenta (o desiste si wait=False). BadRequest se registra."""
+    while True:
+        try:
+            return await make()
+        except RetryAfter as e:
+            if not wait:
+                return None
+            delay = e.retry_after
+            await asyncio.sleep(delay.total_seconds() if hasattr(delay, "total_seconds") else delay)
+        except BadRequest as e:
+            logger.warning(f"Telegram rechazó el mensaje: {e}")
+            return None
+
+async def reply_long(update: Update, text: str) -> None:
+    """Pocos trozos van en paralelo con prefijo (i/n) para ordenarlos; si son más, se envían en secuencia."""
+    chunks = [text[i : i + MAX_LEN] for i in range(0, len(text), MAX_LEN)]
+    if len(chunks) == 1:
+        await tg_call(lambda: update.message.reply_text(chunks[0]))
+        return
+    texts = [f"({idx}/{len(chunks)}) {c}" for idx, c in enumerate(chunks, 1)]
+    if len(texts) <= MAX_PARALLEL_CHUNKS:
+        await asyncio.gather(*(tg_call(partial(update.message.reply_text, t)) for t in texts))
+    else:
+        for t in texts:
+            await tg_call(partial(update.message.reply_text, t))
+
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text("👋 Bot listo.\nComandos: /actualizar /promos /info /modelos /ping")
 
 async def reload_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text("🔄 Recargando catálogo...")
-    catalog = load_all_pdfs()
+    catalog = await asyncio.to_thread(load_all_pdfs)
+    RESPONSE_CACHE.clear()
     await update.message.reply_text(f"✅ Catálogo listo ({len(catalog)} chars)" if catalog else f"⚠️ No hay PDFs en '{PDF_FOLDER}'")
 
 ### async def reload_promos_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -139,102 +510,151 @@ async def reload_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 async def reload_promos_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text("🔄 Recargando promociones y bonificaciones...2")
-    
-    # Mostrar la ruta esperada
-    await update.message.reply_text(f"Ruta esperada: {PROMO_FILE}")
-    
-    # Verificar si el archivo existe
-    if os.path.exists(PROMO_FILE):
-        await update.message.reply_text("✅ Archivo encontrado en el contenedor.")
-    else:
-        await update.message.reply_text("⚠️ Archivo NO encontrado en el contenedor.")
-    
-    # Listar archivos en el directorio actual (para confirmar qué hay)
+    # Diagnóstico en un solo mensaje: ruta esperada, si existe y qué hay en el contenedor
+    found = _mtime(PROMO_FILE) is not None
     files = os.listdir(".")
-    await update.message.reply_text(f"Archivos en el contenedor: {files}")
-    
-    # Intentar cargar promociones
-    promos = load_promotions_and_bonuses()
-    await update.message.reply_text(f"✅ Promociones cargadas ({len(promos)} chars)" if promos else "⚠️ No se encontró el archivo de promociones.")
+    _CATALOG_CACHE.pop("promos", None)
+    RESPONSE_CACHE.clear()
+    _, promos = await asyncio.to_thread(get_promotions)
+    await update.message.reply_text(
+        f"Ruta esperada: {PROMO_FILE}\n"
+        + ("✅ Archivo encontrado en el contenedor.\n" if found else "⚠️ Archivo NO encontrado en el contenedor.\n")
+        + f"Archivos en el contenedor: {files}\n"
+        + (f"✅ Promociones cargadas ({len(promos)} chars)" if promos else "⚠️ No se encontró el archivo de promociones.")
+    )
 
 async def info_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    pdf_files = list(Path(PDF_FOLDER).glob("*.pdf"))
-    info = f"📊 **Catálogo**\n📁 {PDF_FOLDER}\n📄 PDFs: {len(pdf_files)}\n"
-    if os.path.exists(CATALOG_FILE):
-        file_time = datetime.fromtimestamp(os.path.getmtime(CATALOG_FILE))
-        file_size = os.path.getsize(CATALOG_FILE)
-        info += f"🕒 {file_time.strftime('%d/%m/%Y %H:%M')}\n💾 {file_size:,} bytes\n"
-    for pdf in sorted(pdf_files):
-        info += f" • {pdf.name}\n"
-    await update.message.reply_text(info, parse_mode=ParseMode.MARKDOWN)
+    try:
+        with os.scandir(PDF_FOLDER) as it:
+            pdf_names = sorted(e.name for e in it if e.name.endswith(".pdf"))
+    except FileNotFoundError:
+        pdf_names = []
+    info = [f"📊 **Catálogo**\n📁 {PDF_FOLDER}\n📄 PDFs: {len(pdf_names)}\n"]
+    try:
+        st = os.stat(CATALOG_FILE)
+        file_time = datetime.fromtimestamp(st.st_mtime)
+        info.append(f"🕒 {file_time.strftime('%d/%m/%Y %H:%M')}\n💾 {st.st_size:,} bytes\n")
+    except FileNotFoundError:
+        pass
+    info.extend(f" • {name}\n" for name in pdf_names)
+    await update.message.reply_text("".join(info), parse_mode=ParseMode.MARKDOWN)
 
 async def modelos_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-    async with AsyncAnthropic(api_key=ANTHROPIC_API_KEY, http_client=DefaultAioHttpClient(), timeout=30.0) as c:
-        page = await c.models.list()
-        ids = [getattr(m, "id", None) or (isinstance(m, dict) and m.get("id")) for m in getattr(page, "data", []) if m]
-        await update.message.reply_text("🧠 Modelos:\n" + "\n".join(f"• {x}" for x in ids) if ids else "⚠️ Lista vacía")
+    page = await get_anthropic().with_options(timeout=30.0).models.list()
+    ids = [getattr(m, "id", None) or (isinstance(m, dict) and m.get("id")) for m in getattr(page, "data", []) if m]
+    await update.message.reply_text("🧠 Modelos:\n" + "\n".join(f"• {x}" for x in ids) if ids else "⚠️ Lista vacía")
 
 async def ping_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
     try:
-        async with AsyncAnthropic(api_key=ANTHROPIC_API_KEY, http_client=DefaultAioHttpClient(), timeout=20.0) as c:
-            _ = await c.models.list()
-            await update.message.reply_text("✅ Conectado a Anthropic.")
+        _ = await get_anthropic().with_options(timeout=20.0).models.list()
+        await update.message.reply_text("✅ Conectado a Anthropic.")
     except Exception as e:
         await update.message.reply_text(f"❌ No se pudo conectar: {type(e).__name__}: {e}")
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_msg = update.message.text
+    # Lectura/parseo de archivos fuera del event loop (en caché es solo un stat)
+    direct = await asyncio.to_thread(quick_answer, user_msg)
+    if direct is not None:
+        await reply_long(update, direct)
+        return
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-    knowledge = get_full_knowledge()
+    version, knowledge, extra = await asyncio.to_thread(get_knowledge_for, user_msg)
     if not knowledge:
         await update.message.reply_text(f"⚠️ Sin datos. Coloca PDFs y Excel, luego usa /actualizar y /promos.")
         return
-    content = f"BASE DE CONOCIMIENTO:\n{knowledge}\n---\nPregunta: {user_msg}\nResponde en español."
-    async with AsyncAnthropic(api_key=ANTHROPIC_API_KEY, http_client=DefaultAioHttpClient(), timeout=60.0, max_retries=2) as client:
-        model_id = await pick_available_model(client)
-        try:
-            message = await client.messages.create(
-                model=model_id, max_tokens=2048, system=SYSTEM_PROMPT,
-                messages=[{"role": "user", "content": content}],
-            )
-        except Exception as e:
-            await update.message.reply_text(f"❌ Error consultando IA: {e}")
-            return
-        response_text = "".join(getattr(b, "text", "") for b in getattr(message, "content", []) if getattr(b, "type", "") == "text") or "(Sin contenido)"
-        MAX_LEN = 3900
-        for i in range(0, len(response_text), MAX_LEN):
-            await update.message.reply_text(response_text[i : i + MAX_LEN])
-
-# ========= Flask API =========
-web_app = Flask(__name__)
-from flask_cors import CORS
-CORS(web_app)
+    cache_key = RESPONSE_CACHE.key(version, user_msg)
+    response_text = RESPONSE_CACHE.get(cache_key)
+    if response_text is not None:
+        await reply_long(update, response_text)
+        return
+    client = get_anthropic()
+    model_id = await pick_available_model(client)
+    # Streaming: se edita un mismo mensaje a medida que llegan los tokens (máx. 1 edición/seg)
+    msg = await update.message.reply_text("⏳")
+    parts: list[str] = []
+    start, shown = 0, ""  # inicio del mensaje actual dentro del texto y lo ya mostrado
+
+    async def flush(full: str, final: bool = False) -> None:
+        # Errores de Telegram no cortan la respuesta: las ediciones intermedias se saltan
+        # ante RetryAfter; los mensajes ya completos y la edición final esperan y reintentan.
+        nonlocal start, shown
+        while len(full) - start > MAX_LEN:
+            if full[start : start + MAX_LEN] != shown:
+                await show(full[start : start + MAX_LEN], wait=True)
+            start += MAX_LEN
+            await new_placeholder()
+        current = full[start:]
+        if current and current != shown and await show(current, wait=final):
+            shown = current
+
+    async def new_placeholder() -> None:
+        # Si falla, msg queda en None y el siguiente trozo va en un mensaje nuevo (nunca sobre el anterior)
+        nonlocal msg, shown
+        msg, shown = await tg_call(partial(update.message.reply_text, "⏳")), "⏳"
+
+    async def show(text: str, wait: bool) -> bool:
+        nonlocal msg
+        if msg is None:
+            msg = await tg_call(partial(update.message.reply_text, text), wait=wait)
+            return msg is not None
+        return await tg_call(partial(msg.edit_text, text), wait=wait) is not None
+
+    try:
+        last_edit = time.monotonic()
+        async with client.messages.stream(
+            model=model_id, max_tokens=2048, system=SYSTEM_BLOCKS,
+            messages=build_messages(knowledge, user_msg, extra),
+        ) as stream:
+            async for text in stream.text_stream:
+                parts.append(text)
+                if time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL:
+                    await flush("".join(parts))
+                    last_edit = time.monotonic()
+    except APIError as e:
+        error_text = f"❌ Error consultando IA: {e}"
+        if parts or msg is None:
+            await tg_call(partial(update.message.reply_text, error_text))
+        else:
+            await tg_call(partial(msg.edit_text, error_text))
+        return
+    response_text = "".join(parts) or "(Sin contenido)"
+    RESPONSE_CACHE.set(cache_key, response_text)
+    await flush(response_text, final=True)
+
+# ========= API web (ASGI) =========
+# Quart + uvicorn en el mismo event loop que el bot: comparten el cliente de Anthropic
+web_app = cors(Quart(__name__))
 
 @web_app.route("/consulta", methods=["POST"])
-def consulta():
-    pregunta = request.json.get("pregunta")
-    knowledge = get_full_knowledge()
+async def consulta():
+    data = await request.get_json(silent=True)
+    pregunta = data.get("pregunta") if isinstance(data, dict) else None
+    if not isinstance(pregunta, str) or not pregunta.strip():
+        return jsonify({"error": "Falta 'pregunta' (texto)"}), 400
+    respuesta = await asyncio.to_thread(quick_answer, pregunta)
+    if respuesta is not None:
+        return jsonify({"respuesta": respuesta})
+    version, knowledge, extra = await asyncio.to_thread(get_knowledge_for, pregunta)
     if not knowledge:
         return jsonify({"error": "Sin datos cargados"}), 400
-    content = f"BASE DE CONOCIMIENTO:\n{knowledge}\n---\nPregunta: {pregunta}\nResponde en español."
-    import asyncio
-    async def call_anthropic():
-        async with AsyncAnthropic(api_key=ANTHROPIC_API_KEY, http_client=DefaultAioHttpClient(), timeout=60.0, max_retries=2) as client:
-            model_id = await pick_available_model(client)
-            message = await client.messages.create(
-                model=model_id, max_tokens=2048, system=SYSTEM_PROMPT,
-                messages=[{"role": "user", "content": content}],
-            )
-            return "".join(getattr(b, "text", "") for b in getattr(message, "content", []) if getattr(b, "type", "") == "text") or "(Sin contenido)"
-    respuesta = asyncio.run(call_anthropic())
+    cache_key = RESPONSE_CACHE.key(version, pregunta)
+    respuesta = RESPONSE_CACHE.get(cache_key)
+    if respuesta is not None:
+        return jsonify({"respuesta": respuesta})
+    client = get_anthropic()
+    model_id = await pick_available_model(client)
+    message = await client.messages.create(
+        model=model_id, max_tokens=2048, system=SYSTEM_BLOCKS,
+        messages=build_messages(knowledge, pregunta, extra),
+    )
+    respuesta = "".join([b.text for b in message.content or [] if b.type == "text"]) or "(Sin contenido)"
+    RESPONSE_CACHE.set(cache_key, respuesta)
     return jsonify({"respuesta": respuesta})
 
-def run_flask():
-    web_app.run(host="0.0.0.0", port=int(os.getenv("PORT", 8000)))
-
-def run_telegram():
+def build_telegram_app():
     app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
     app.add_handler(CommandHandler("start", start_command))
     app.add_handler(CommandHandler("actualizar", reload_command))
@@ -243,8 +663,34 @@ def run_telegram():
     app.add_handler(CommandHandler("modelos", modelos_command))
     app.add_handler(CommandHandler("ping", ping_command))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    app.run_polling()
+    return app
+
+class WebServer(uvicorn.Server):
+    """uvicorn sin sus propios manejadores de señales.
+
+    El de uvicorn vuelve a lanzar la señal al terminar y el proceso muere antes del apagado
+    del bot; aquí main() atiende SIGINT/SIGTERM y solo marca should_exit.
+    """
+
+    @contextlib.contextmanager
+    def capture_signals(self):
+        yield
+
+async def main() -> None:
+    server = WebServer(uvicorn.Config(web_app, host="0.0.0.0", port=int(os.getenv("PORT", 8000))))
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, setattr, server, "should_exit", True)
+    app = build_telegram_app()
+    async with app:
+        await app.start()
+        await app.updater.start_polling()
+        try:
+            await server.serve()  # bloquea hasta SIGINT/SIGTERM
+        finally:
+            await app.updater.stop()
+            await app.stop()
+            await close_anthropic()
 
 if __name__ == "__main__":
-    threading.Thread(target=run_flask).start()
-    run_telegram()
+    asyncio.run(main())